@@ -111,9 +111,10 @@ Built into this library is the ability to play scripts of commands: simply
 invoke the program with "-play <file>" and it will play the commands in the
 file, waiting for a specified pause between them.  You can set this pause (in
 seconds, and fractions of a second are fine) from the command line too:
-"-pause <secs>".  Note that the program deliberately busy-waits during these
-pauses so that animations continue to play out -- don't be tempted to
-'improve' the code by replacing the pauses with invocations of time.sleep().
+"-pause <secs>".  Note that the program deliberately keeps calling the idle
+callback during these pauses so that animations continue to play out; it only
+ever blocks for a millisecond at a time, waking early if a command arrives --
+don't be tempted to 'improve' the code by sleeping for the whole pause.
 
 Finally, please note that this software is under fairly continuous
 development.  Please do not distribute it without the author's permission; his
@@ -122,14 +123,19 @@ contact details are at the foot of this file."""
 #-------------------------------------------------------------------------------
 # Boilerplate.
 #-------------------------------------------------------------------------------
-from __future__ import division
-import argparse, copy, errno, os, random, select, socket
+from __future__ import annotations
+import argparse, collections, copy, ctypes, errno, os, select, socket
 from PIL import Image
-import string, sys, time
+import queue, subprocess, sys, threading, time
+import numpy
 from math import *
 from OpenGL.GLUT import *
 from OpenGL.GLU import *
 from OpenGL.GL import *
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:        # only type checkers need these, for the annotations
+    from typing import List, Optional, TextIO, Tuple
+    Vec3 = Tuple[float, float, float]
 
 #-------------------------------------------------------------------------------
 # Global variables.
@@ -138,13 +144,18 @@ fov = 60                 # half the field-of-view of the OpenGL camera
 near = 0.01              # near clipping distance
 far = 2000               # far clipping distance
 
-seed = random.random ()  # use a random seed unless one is supplied
+seed = None              # use a random seed unless one is supplied
+rng = None               # random number generator, created on first use
 
 CX, CY, CZ = (0, 0, 0)   # start at the origin...
 VX, VY, VZ = (0, 0, 10)  # looking along the +z axis...
 UX, UY, UZ = (0, 1, 0)   # with +y being upwards
 
+deg2rad = pi / 180.0     # multiply by these to convert degrees to radians...
+rad2deg = 180.0 / pi     # and back again
+
 default_angle = 1        # default rotation in degrees
+default_angle_rad = default_angle * deg2rad  # the same in radians
 default_step = 0.5       # default translation
 
 iCX = iCY = iCZ = None   # initial viewpoint (used for "reset_viewpoint")
@@ -156,8 +167,10 @@ pause = 0.0              # slug applications if > 0
 idle_callback = None     # program's idle callback
 keyboard_callback = None # program's keyboard callback
 command_callback = None  # program's command-handling callback
-cmd_table = {}           # command -> corresponding key
+cmd_table = {}           # command -> tuple of corresponding keys
 key_table = {}           # key -> corresponding command
+                         # (both filled from nil.kbd by init, or by
+                         # ensure_keys_loaded if needed before that)
 
 motion_mode = "F"        # initial motion mode
 motion_mode_names = {    # supported motion modes
@@ -166,6 +179,14 @@ motion_mode_names = {    # supported motion modes
     "V": "view"}
 
 wait_until = 0           # filled when we're busy waiting for an animation
+view_cache = None        # (viewpoint, polar form) of the last view vector
+modelview_cache = None   # (viewpoint, gtm, matrix) of the last modelview
+
+command_poller = None    # epoll (or poll) object watching the controller
+command_pending = collections.deque ()  # commands received but not yet obeyed
+command_partial = bytearray ()          # the start of a command still arriving
+command_buffer = bytearray (65536)      # re-used for every read from the socket
+command_rcvbuf = 4 * 1024 * 1024        # kernel buffer to absorb bursts of input
 
 #-------------------------------------------------------------------------------
 # Routines for registering callbacks.
@@ -185,12 +206,31 @@ def commandfunc (func):
     global command_callback
     command_callback = func
 
+#-------------------------------------------------------------------------------
+# Random numbers.
+#-------------------------------------------------------------------------------
+def get_rng ():
+    """Return the random number generator, a numpy Generator, seeding it on
+    first use; draws of many numbers at once are best made as arrays."""
+    global rng, seed
+    if rng is None:
+        if seed is None:
+            seed = numpy.random.SeedSequence ().entropy
+        rng = numpy.random.default_rng (seed)
+    return rng
+
 #-------------------------------------------------------------------------------
 # Routines for saving rendered images of OpenGL models to files.
 #-------------------------------------------------------------------------------
 saving_mode = False
 save_template = "frame-%5.5d.png"
 save_frame_number = 0
+save_pbos = []           # pixel-pack buffers free for asynchronous read-back
+save_pbo_size = 0        # size in bytes of each of those buffers
+save_pending = collections.deque ()  # (pbo, fence, filename, width, height,
+                                     # format) of frames being read back
+save_queue = None        # frames waiting for the writer thread to encode
+save_error = None        # what stopped the writer thread saving, if anything
 
 def saving ():
     "Return the saving mode."
@@ -199,32 +239,201 @@ def saving ():
 
 def set_saving_mode (state):
     "Set the saving mode."
-    global saving_mode
+    global saving_mode, save_error
     saving_mode = state
+    if state: save_error = None
+    else: flush_saved_frames ()
 
 def frame_posted ():
     """Process a newly-displayed frame, intended to be called by the display
     callback after glutSwapBuffers."""
-    global save_frame_number
+    global save_frame_number, save_error
 
+    # Stop saving if the writer thread could not write out a frame.
+    if saving () and save_error is not None:
+        print ("[stopped saving frames]", file=sys.stderr)
+        set_saving_mode (False)
     if saving () and save_frame_number > 0:
         save_frame ()
     save_frame_number += 1
+    time_frame ()
 
 def save_frame (format="PNG"):
-    "Save the OpenGL window to a file."
+    """Save the OpenGL window to a file.  Where pixel buffer objects and
+    fences are available, the read-back is asynchronous: the copy of the
+    frame into a buffer is started here, and the frame is written out by
+    write_pending_frames once the GPU has signalled that it is complete.
+    Call flush_saved_frames to make sure every frame has been written."""
     global window_width, window_height
     global save_template, save_frame_number
+    global save_pbos, save_pbo_size, save_pending
 
     glPixelStorei (GL_PACK_ALIGNMENT, 1)
-    data = glReadPixels (0, 0, window_width, window_height, GL_RGB,
-                         GL_UNSIGNED_BYTE)
-    image = Image.frombytes ("RGB", (window_width, window_height), data)
-    image = image.transpose (Image.FLIP_TOP_BOTTOM)
     filename = save_template % save_frame_number
-    image.save (filename, format)
-    print >>sys.stderr, "[saved %dx%d image to %s]" % \
-        (window_width, window_height, filename)
+    if not (bool (glGenBuffers) and bool (glMapBufferRange) and
+            bool (glFenceSync)):
+        data = glReadPixels (0, 0, window_width, window_height, GL_RGB,
+                             GL_UNSIGNED_BYTE)
+        write_frame (data, window_width, window_height, filename, format)
+        return
+
+    # (Re-)allocate a few buffers the size of the window if need be.
+    size = window_width * window_height * 3
+    if size != save_pbo_size:
+        write_pending_frames (True)
+        if save_pbos: glDeleteBuffers (len (save_pbos), save_pbos)
+        save_pbos = list (glGenBuffers (3))
+        for pbo in save_pbos:
+            glBindBuffer (GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData (GL_PIXEL_PACK_BUFFER, size, None, GL_STREAM_READ)
+        save_pbo_size = size
+
+    # If every buffer is still in use, we have no choice but to wait.
+    if not save_pbos: write_pending_frames (True)
+
+    # Start the copy of this frame into a free buffer; with a pack buffer
+    # bound, glReadPixels returns without waiting for the data.  The fence
+    # tells us when the copy has finished.
+    pbo = save_pbos.pop ()
+    glBindBuffer (GL_PIXEL_PACK_BUFFER, pbo)
+    glReadPixels (0, 0, window_width, window_height, GL_RGB,
+                  GL_UNSIGNED_BYTE, ctypes.c_void_p (0))
+    glBindBuffer (GL_PIXEL_PACK_BUFFER, 0)
+    fence = glFenceSync (GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+    save_pending.append ((pbo, fence, filename, window_width, window_height,
+                          format))
+
+def flush_saved_frames ():
+    """Write out any frames whose asynchronous read-back is still outstanding
+    and wait for the writer thread to finish with all frames."""
+    global save_queue
+    write_pending_frames (True)
+    if save_queue is not None: save_queue.join ()
+
+def write_pending_frames (block=False):
+    """Hand the frames whose read-back has completed to the writer thread.
+    This is called from the idle callback, when it returns immediately
+    rather than waiting for read-backs that are still in progress; if
+    block is True, it waits for all of them."""
+    global save_pbos, save_pbo_size, save_pending
+
+    while save_pending:
+        pbo, fence, filename, width, height, format = save_pending[0]
+        status = glClientWaitSync (fence, GL_SYNC_FLUSH_COMMANDS_BIT, 0)
+        while block and status == GL_TIMEOUT_EXPIRED:
+            status = glClientWaitSync (fence, GL_SYNC_FLUSH_COMMANDS_BIT,
+                                       1000000000)
+        if status == GL_TIMEOUT_EXPIRED: return
+        glDeleteSync (fence)
+        save_pending.popleft ()
+
+        # Map the buffer and copy the pixels out, so that the buffer is free
+        # for re-use while the writer thread encodes them.
+        glBindBuffer (GL_PIXEL_PACK_BUFFER, pbo)
+        ptr = glMapBufferRange (GL_PIXEL_PACK_BUFFER, 0, save_pbo_size,
+                                GL_MAP_READ_BIT)
+        data = ctypes.string_at (ptr, width * height * 3)
+        glUnmapBuffer (GL_PIXEL_PACK_BUFFER)
+        glBindBuffer (GL_PIXEL_PACK_BUFFER, 0)
+        save_pbos.append (pbo)
+        write_frame (data, width, height, filename, format)
+
+def write_frame (data, width, height, filename, format):
+    """Queue a frame of bottom-up RGB pixels to be written to a file, starting
+    the writer thread if need be.  The queue is short, so this blocks rather
+    than letting unwritten frames pile up in memory."""
+    global save_queue
+    if save_queue is None:
+        save_queue = queue.Queue (4)
+        writer = threading.Thread (target=frame_writer)
+        writer.daemon = True
+        writer.start ()
+    save_queue.put ((data, width, height, filename, format))
+
+def frame_writer ():
+    """Encode and write out queued frames; this runs in a thread of its own.
+    The first error met is reported and left in save_error for the main
+    thread, and frames queued after it are discarded."""
+    global save_queue, save_error
+    while True:
+        data, width, height, filename, format = save_queue.get ()
+        try:
+            if save_error is not None: continue
+            # OpenGL stores the rows bottom-up, so the negative stride flips
+            # the image as PIL decodes it.  Frames are usually made into a
+            # movie afterwards, so favour speed over size when compressing.
+            image = Image.frombuffer ("RGB", (width, height), data,
+                                      "raw", "RGB", 0, -1)
+            if format == "PNG":
+                image.save (filename, format, compress_level=1)
+            else:
+                image.save (filename, format)
+            print ("[saved %dx%d image to %s]" % (width, height, filename),
+                   file=sys.stderr)
+        except Exception as e:
+            save_error = e
+            print ("[failed to save %s: %s]" % (filename, e), file=sys.stderr)
+        finally:
+            save_queue.task_done ()
+
+#-------------------------------------------------------------------------------
+# Routines for pacing frames by when the GPU has finished drawing them.
+#-------------------------------------------------------------------------------
+frame_timing = None      # whether timestamp queries are supported
+frame_queries = []       # timestamp queries not currently in use
+frame_queries_issued = collections.deque ()  # queries the GPU has yet to reach
+frame_queries_max = 8    # the most frames timed at once
+last_gpu_timestamp = None
+gpu_frame_time = None    # GPU time in seconds between the last two frames
+
+def time_frame ():
+    """Ask the GPU to record when it finishes the frame just posted.  This
+    is done asynchronously, so the caller never waits for the GPU."""
+    global frame_timing, frame_queries, frame_queries_issued
+
+    if frame_timing is None: frame_timing = bool (glQueryCounter)
+    if not frame_timing: return
+    # Take back the queries the GPU has finished with before issuing another,
+    # so that only as many exist as there are frames in flight.
+    collect_frame_queries ()
+    if len (frame_queries_issued) >= frame_queries_max: return
+    if not frame_queries: frame_queries = list (glGenQueries (2))
+    q = frame_queries.pop ()
+    glQueryCounter (q, GL_TIMESTAMP)
+    frame_queries_issued.append (q)
+
+def gpu_ready ():
+    """Say whether the GPU has caught up enough for another frame to be
+    posted, which is once it has finished all but the most recent frame.
+    The GPU time between frames is recorded in gpu_frame_time as a
+    side-effect."""
+    global frame_queries_issued
+    collect_frame_queries ()
+    return len (frame_queries_issued) <= 1
+
+def collect_frame_queries ():
+    """Return the queries of the frames the GPU has finished to the pool,
+    recording the GPU time between the last two in gpu_frame_time."""
+    global frame_queries, frame_queries_issued
+    global last_gpu_timestamp, gpu_frame_time
+
+    while frame_queries_issued:
+        q = frame_queries_issued[0]
+        available = ctypes.c_int (0)
+        glGetQueryObjectiv (q, GL_QUERY_RESULT_AVAILABLE, available)
+        if not available.value: break
+        stamp = ctypes.c_uint64 (0)
+        glGetQueryObjectui64v (q, GL_QUERY_RESULT, stamp)
+        if last_gpu_timestamp is not None:
+            gpu_frame_time = (stamp.value - last_gpu_timestamp) * 1.0e-9
+        last_gpu_timestamp = stamp.value
+        frame_queries.append (frame_queries_issued.popleft ())
+
+def get_gpu_frame_time ():
+    """Return the GPU time in seconds between the last two frames to be
+    completed, or None if it is not (yet) known."""
+    global gpu_frame_time
+    return gpu_frame_time
 
 #-------------------------------------------------------------------------------
 # Routines to navigate through OpenGL models.
@@ -232,7 +441,37 @@ def save_frame (format="PNG"):
 def get_viewpoint ():
     "Return the viewpoint, applying any global scale factor."
     global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ, gsf
-    return (CX*gsf, CY*gsf, CZ*gsf, VX*gsf, VY*gsf, VZ*gsf, UX, UY, UZ)
+    s = gsf
+    return (CX*s, CY*s, CZ*s, VX*s, VY*s, VZ*s, UX, UY, UZ)
+
+def get_modelview ():
+    """Return the modelview matrix for the current viewpoint, ready to be
+    passed to glLoadMatrixf.  This is the matrix that glLoadIdentity,
+    glMultMatrixf (gtm) and gluLookAt (*get_viewpoint ()) would produce,
+    but it is worked out again only when the viewpoint has changed."""
+    global gtm, modelview_cache
+    vp = get_viewpoint ()
+    if modelview_cache is not None and modelview_cache[0] == vp and \
+       modelview_cache[1] is gtm:
+        return modelview_cache[2]
+
+    # Build the look-at matrix in the same way as gluLookAt: f points from
+    # the camera to the viewpoint, s to the right and u upwards.
+    eye = numpy.array (vp[0:3], dtype=float)
+    f = normalize (numpy.array (vp[3:6], dtype=float) - eye)
+    s = normalize (vector_product (f, vp[6:9]))
+    u = vector_product (s, f)
+    look = numpy.identity (4)
+    look[0,:3] = s
+    look[1,:3] = u
+    look[2,:3] = -f
+    look[:3,3] = -look[:3,:3].dot (eye)
+
+    # Pre-multiply it by gtm; both gtm and the result are column-major.
+    m = numpy.dot (numpy.reshape (gtm, (4, 4)).T, look)
+    matrix = (GLfloat * 16) (*m.T.ravel ())
+    modelview_cache = (vp, gtm, matrix)
+    return matrix
 
 def reset_viewpoint ():
     "Reset the viewpoint to its initial value and re-enable fly mode."
@@ -283,20 +522,34 @@ def set_gsf (v):
     global gsf
     gsf = v
 
+def set_motion_mode (mode):
+    """Set the motion mode, binding move_forward and the rotation routines to
+    the versions for that mode so that they need not test it on every call."""
+    global motion_mode
+    global move_forward, rotate_vertically_rad, rotate_horizontally_rad
+    motion_mode = mode
+    if mode == "W":
+        move_forward = move_forward_walking
+    else:
+        move_forward = move_forward_flying
+    if mode == "V":
+        rotate_vertically_rad = rotate_vertically_about_viewpoint
+        rotate_horizontally_rad = rotate_horizontally_about_viewpoint
+    else:
+        rotate_vertically_rad = rotate_vertically_about_camera
+        rotate_horizontally_rad = rotate_horizontally_about_camera
+
 def view_mode ():
     "Set motion to be in view mode."
-    global motion_mode
-    motion_mode = "V"
+    set_motion_mode ("V")
 
 def fly_mode ():
     "Set motion to be in fly mode."
-    global motion_mode
-    motion_mode = "F"
+    set_motion_mode ("F")
 
 def walk_mode ():
     "Set motion to be in walk mode."
-    global motion_mode
-    motion_mode = "W"
+    set_motion_mode ("W")
 
 def set_translation_step (v):
     "Set the step size when translating."
@@ -309,54 +562,80 @@ def get_translation_step ():
     return default_step
 
 def set_rotation_step (v):
-    "Set the step size when rotating."
-    global default_angle
+    "Set the step size when rotating, in degrees."
+    global default_angle, default_angle_rad
     default_angle = v
+    default_angle_rad = v * deg2rad
 
 def get_rotation_step (v):
     "Get the step size when rotating."
     global default_angle
     return default_angle
 
-def move_forward (dist):
-    "Move the camera and viewpoint forward by an amount dist."
-    global motion_mode
-    global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
+# move_forward (dist) moves the camera and viewpoint forward by an amount
+# dist.  It is bound by set_motion_mode to one of the following.
 
-    dx = VX - CX
-    dy = VY - CY
-    dz = VZ - CZ
-    veclen = sqrt (dx**2 + dy**2 + dz**2)
-    fac = dist / veclen
-    CX += fac * dx
-    if motion_mode != "W": CY += fac * dy
-    CZ += fac * dz
-    VX += fac * dx
-    if motion_mode != "W": VY += fac * dy
-    VZ += fac * dz
-
-def move_left (dist):
-    "Move the camera sideways by an amount dist."
+def move_forward_flying (dist: float) -> None:
+    "Move the camera and viewpoint forward by dist in fly or view mode."
     global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
 
-    dx = VX - CX
-    dy = VY - CY
-    dz = VZ - CZ
-    veclen = sqrt (dx**2 + dy**2 + dz**2)
-    lat = asin (dy / veclen)
-    lon = atan2 (dz, dx)
-
-    # "Sideways" is always 90 degrees away from the current longitude.
-    direc = lon - pi / 2.0
-    dxnew = cos (lat) * cos (direc)
-    dznew = cos (lat) * sin (direc)
+    # Work on local copies of the viewpoint, which are much cheaper to
+    # access than the globals, and store the results back at the end.  Both
+    # camera and viewpoint move by dist along the unit view vector.
+    cx, cy, cz, vx, vy, vz = CX, CY, CZ, VX, VY, VZ
+    dx = vx - cx
+    dy = vy - cy
+    dz = vz - cz
+    fac = dist / sqrt (dx*dx + dy*dy + dz*dz)
+    dx *= fac
+    dy *= fac
+    dz *= fac
+    CX = cx + dx
+    CY = cy + dy
+    CZ = cz + dz
+    VX = vx + dx
+    VY = vy + dy
+    VZ = vz + dz
+
+def move_forward_walking (dist: float) -> None:
+    """Move the camera and viewpoint forward by dist in walk mode, where the
+    height does not change."""
+    global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
 
-    CX += dxnew * dist
-    CZ += dznew * dist
-    VX += dxnew * dist
-    VZ += dznew * dist
+    # As in move_forward_flying but leaving the y-values alone.
+    cx, cy, cz, vx, vy, vz = CX, CY, CZ, VX, VY, VZ
+    dx = vx - cx
+    dy = vy - cy
+    dz = vz - cz
+    fac = dist / sqrt (dx*dx + dy*dy + dz*dz)
+    dx *= fac
+    dz *= fac
+    CX = cx + dx
+    CZ = cz + dz
+    VX = vx + dx
+    VZ = vz + dz
+
+def move_left (dist: float) -> None:
+    "Move the camera sideways by an amount dist."
+    global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
 
-def move_up (dist):
+    # "Sideways" is always 90 degrees away from the current longitude, which
+    # is the horizontal part of the view vector rotated to (dz, -dx); scaling
+    # by the full vector length gives the cos(latitude) factor for free.
+    cx, cy, cz, vx, vy, vz = CX, CY, CZ, VX, VY, VZ
+    dx = vx - cx
+    dy = vy - cy
+    dz = vz - cz
+    fac = dist / sqrt (dx*dx + dy*dy + dz*dz)
+    dxnew = dz * fac
+    dznew = -dx * fac
+
+    CX = cx + dxnew
+    CZ = cz + dznew
+    VX = vx + dxnew
+    VZ = vz + dznew
+
+def move_up (dist: float) -> None:
     "Move the camera and viewpoint upward by an amount dist."
     global motion_mode
     global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
@@ -365,83 +644,142 @@ def move_up (dist):
         CY += dist
         VY += dist
 
-def rotate_vertically (angle):
+def vector_polar (dx: float, dy: float, dz: float) -> Vec3:
+    "Return the length, latitude and cos (latitude) of a vector."
+    veclen = sqrt (dx*dx + dy*dy + dz*dz)
+    lat = asin (dy / veclen)
+    return (veclen, lat, cos (lat))
+
+def rotate_vector_vertically (dx: float, dy: float, dz: float, angle: float,
+                              polar: Optional[Vec3] = None
+                              ) -> Tuple[Vec3, Vec3]:
+    """Rotate the vector (dx, dy, dz) through angle RADIANS in the vertical
+    plane that contains it, returning the rotated vector and its polar form.
+    If the polar form of the original vector is known, it can be passed in
+    to save working it out again."""
+    veclen, lat, coslat = polar or vector_polar (dx, dy, dz)
+    # The horizontal components both scale by cos(lat+angle) / cos(lat), so
+    # work that out once rather than separately for x and z.
+    lat += angle
+    coslat_new = cos (lat)
+    k = coslat_new / coslat
+    return (dx * k, veclen * sin (lat), dz * k), (veclen, lat, coslat_new)
+
+def rotate_vector_horizontally (dx: float, dz: float, angle: float
+                                ) -> Tuple[float, float]:
+    """Rotate the horizontal part (dx, dz) of a vector through angle RADIANS
+    about the y-axis, returning the rotated components."""
+    # This is the same as adding angle to the longitude, but avoids having to
+    # find the latitude and longitude in the first place.
+    c = cos (angle)
+    s = sin (angle)
+    return (dx * c - dz * s, dx * s + dz * c)
+
+def cached_view_polar (vp):
+    """Return the polar form of the view vector if it was remembered for the
+    viewpoint vp, or None if it must be worked out afresh."""
+    global view_cache
+    if view_cache is not None and view_cache[0] == vp:
+        return view_cache[1]
+    return None
+
+def remember_view_polar (vp, polar):
+    """Remember the polar form of the view vector for viewpoint vp, so that
+    the next rotation need not work it out.  Rotating beyond the vertical
+    turns the view over, so that is left to be worked out afresh."""
+    global view_cache
+    if abs (polar[1]) < pi / 2:
+        view_cache = (vp, polar)
+    else:
+        view_cache = None
+
+# rotate_vertically_rad (angle) and rotate_horizontally_rad (angle) rotate
+# the viewpoint through angle RADIANS.  They are bound by set_motion_mode to
+# the versions that rotate about the viewpoint (view mode) or about the
+# camera (fly and walk modes).
+
+def rotate_vertically (angle: float) -> None:
     """Rotate the viewpoint vertically through angle DEGREES.  This
     will fail if we end up looking vertically."""
-    global motion_mode
+    rotate_vertically_rad (angle * deg2rad)
+
+def rotate_vertically_about_camera (angle: float) -> None:
+    "Turn the camera vertically through angle RADIANS."
     global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
 
-    angle = rad (angle)
-    if motion_mode == "V":
-        dx = CX - VX
-        dy = CY - VY
-        dz = CZ - VZ
-        veclen = sqrt (dx**2 + dy**2 + dz**2)
-        lat = asin (dy / veclen)
-        Rcoslon = dx / cos (lat)
-        dxnew = Rcoslon * cos (lat + angle)
-        CX = VX + dxnew
-        Rsinlon = dz / cos (lat)
-        dznew = Rsinlon * cos (lat + angle)
-        CZ = VZ + dznew
-        CY = VY + veclen * sin (lat + angle)
-    else:
-        dx = VX - CX
-        dy = VY - CY
-        dz = VZ - CZ
-        veclen = sqrt (dx**2 + dy**2 + dz**2)
-        lat = asin (dy / veclen)
-        Rcoslon = dx / cos (lat)
-        dxnew = Rcoslon * cos (lat + angle)
-        VX = CX + dxnew
-        Rsinlon = dz / cos (lat)
-        dznew = Rsinlon * cos (lat + angle)
-        VZ = CZ + dznew
-        VY = CY + veclen * sin (lat + angle)
-
-def rotate_horizontally (angle):
+    # As in move_forward_flying, work on local copies of the viewpoint.
+    cx, cy, cz, vx, vy, vz = CX, CY, CZ, VX, VY, VZ
+    polar = cached_view_polar ((cx, cy, cz, vx, vy, vz, False))
+    (dx, dy, dz), polar = rotate_vector_vertically (vx - cx, vy - cy,
+                                                    vz - cz, angle, polar)
+    vx = cx + dx
+    vy = cy + dy
+    vz = cz + dz
+    VX, VY, VZ = vx, vy, vz
+    remember_view_polar ((cx, cy, cz, vx, vy, vz, False), polar)
+
+def rotate_vertically_about_viewpoint (angle: float) -> None:
+    "Move the camera vertically through angle RADIANS around the viewpoint."
+    global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
+
+    cx, cy, cz, vx, vy, vz = CX, CY, CZ, VX, VY, VZ
+    polar = cached_view_polar ((cx, cy, cz, vx, vy, vz, True))
+    (dx, dy, dz), polar = rotate_vector_vertically (cx - vx, cy - vy,
+                                                    cz - vz, angle, polar)
+    cx = vx + dx
+    cy = vy + dy
+    cz = vz + dz
+    CX, CY, CZ = cx, cy, cz
+    remember_view_polar ((cx, cy, cz, vx, vy, vz, True), polar)
+
+def rotate_horizontally (angle: float) -> None:
     """Rotate the viewpoint horizontally through angle DEGREES.  This
     will fail if we are looking vertically."""
-    global motion_mode
+    rotate_horizontally_rad (angle * deg2rad)
+
+def rotate_horizontally_about_camera (angle: float) -> None:
+    "Turn the camera horizontally through angle RADIANS."
     global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
 
-    angle = rad (angle)
-    if motion_mode == "V":
-        dx = CX - VX
-        dy = CY - VY
-        dz = CZ - VZ
-        veclen = sqrt (dx**2 + dy**2 + dz**2)
-        lat = asin (dy / veclen)
-        lon = atan2 (dz, dx)
-        dxnew = veclen * cos (lat) * cos (lon + angle)
-        dznew = veclen * cos (lat) * sin (lon + angle)
-        CX = VX + dxnew
-        CZ = VZ + dznew
-    else:
-        angle = -angle     # so that +z -> +x if angle > 0
-        dx = VX - CX
-        dy = VY - CY
-        dz = VZ - CZ
-        veclen = sqrt (dx**2 + dy**2 + dz**2)
-        lat = asin (dy / veclen)
-        lon = atan2 (dz, dx)
-        dxnew = veclen * cos (lat) * cos (lon + angle)
-        dznew = veclen * cos (lat) * sin (lon + angle)
-        VX = CX + dxnew
-        VZ = CZ + dznew
-
-def print_location (text="", f=sys.stdout):
+    # Negate the angle so that +z -> +x if angle > 0.  Turning horizontally
+    # changes neither the length nor the latitude of the view vector, so
+    # anything we knew about them still holds.
+    cx, cy, cz, vx, vy, vz = CX, CY, CZ, VX, VY, VZ
+    polar = cached_view_polar ((cx, cy, cz, vx, vy, vz, False))
+    dx, dz = rotate_vector_horizontally (vx - cx, vz - cz, -angle)
+    vx = cx + dx
+    vz = cz + dz
+    VX, VZ = vx, vz
+    if polar is not None:
+        remember_view_polar ((cx, cy, cz, vx, vy, vz, False), polar)
+
+def rotate_horizontally_about_viewpoint (angle: float) -> None:
+    "Move the camera horizontally through angle RADIANS around the viewpoint."
+    global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
+
+    cx, cy, cz, vx, vy, vz = CX, CY, CZ, VX, VY, VZ
+    polar = cached_view_polar ((cx, cy, cz, vx, vy, vz, True))
+    dx, dz = rotate_vector_horizontally (cx - vx, cz - vz, angle)
+    cx = vx + dx
+    cz = vz + dz
+    CX, CZ = cx, cz
+    if polar is not None:
+        remember_view_polar ((cx, cy, cz, vx, vy, vz, True), polar)
+
+set_motion_mode (motion_mode)   # bind the routines for the initial mode
+
+def print_location (text: str = "", f: TextIO = sys.stdout) -> None:
     global motion_mode, motion_mode_names
     global CX, CY, CZ, VX, VY, VZ, UX, UY, UZ
     global first_print_call
 
     if first_print_call:
-        print "%7s %7s %7s  %7s %7s %7s  %7s %7s %7s %s" % \
-          ("CX", "CY", "CZ", "VX", "VY", "VZ", "UX", "UY", "UZ", "mode")
+        print ("%7s %7s %7s  %7s %7s %7s  %7s %7s %7s %s" %
+          ("CX", "CY", "CZ", "VX", "VY", "VZ", "UX", "UY", "UZ", "mode"))
         first_print_call = False
 
-    print "%7.2f %7.2f %7.2f  %7.2f %7.2f %7.2f  %7.2f %7.2f %7.2f %-7s %s" % \
-    (CX, CY, CZ, VX, VY, VZ, UX, UY, UZ, motion_mode_names[motion_mode], text)
+    print ("%7.2f %7.2f %7.2f  %7.2f %7.2f %7.2f  %7.2f %7.2f %7.2f %-7s %s" %
+    (CX, CY, CZ, VX, VY, VZ, UX, UY, UZ, motion_mode_names[motion_mode], text))
 
 #-------------------------------------------------------------------------------
 # OpenGL callback routines.
@@ -461,33 +799,81 @@ def reshape (w, h):
     glLoadIdentity ()
     glutPostRedisplay ()
 
+# The help text output by print_keystrokes, filled in from the last key given
+# for each command in cmd_table.
+keystrokes_template = """\
+              TRANSLATION                          ROTATION
+
+                (up)  (forward)                      (up)
+                   %(move_up)s  %(move_forward)s                               %(turn_up)s
+                   | /                                |
+                   |/                                 |
+      (left)  %(move_left)s----+----%(move_right)s  (right)       (left)  %(turn_left)s----+----%(turn_right)s  (right)
+                  /|                                  |
+                 / |                                  |
+                %(move_backward)s  %(move_down)s                                  %(turn_down)s
+       (backward)  (down)                          (down)
+
+  F  fly navigation mode          +  increase step size by 10%%
+  W  walk navigation mode         -  decrease step size by 10%%
+  V  view navigation mode         <  increase angle step by 10%%
+  R  reset                        >  decrease angle step by 10%%
+  H  print this help              ?  print viewpoint
+  q  exit
+"""
+keystrokes_text = None   # keystrokes_template filled in, once it is needed
+
 def print_keystrokes (f=sys.stdout):
     "Output the supported keystrokes."
-    global cmd_table
-    print >>f, "              TRANSLATION                          ROTATION"
-    print >>f, ""
-    print >>f, "                (up)  (forward)                      (up)"
-    print >>f, "                   %s  %s                               %s" % \
-      (cmd_table["move_up"], cmd_table["move_forward"], cmd_table["turn_up"])
-    print >>f, "                   | /                                |"
-    print >>f, "                   |/                                 |"
-    print >>f, "      (left)  %s----+----%s  (right)" % \
-      (cmd_table["move_left"], cmd_table["move_right"]),
-    print >>f, "      (left)  %s----+----%s  (right)" % \
-      (cmd_table["turn_left"], cmd_table["turn_right"])
-    print >>f, "                  /|                                  |"
-    print >>f, "                 / |                                  |"
-    print >>f, "                %s  %s                                  %s" % \
-      (cmd_table["move_backward"], cmd_table["move_down"],
-       cmd_table["turn_down"])
-    print >>f, "       (backward)  (down)                          (down)"
-    print >>f, ""
-    print >>f, "  F  fly navigation mode          +  increase step size by 10%"
-    print >>f, "  W  walk navigation mode         -  decrease step size by 10%"
-    print >>f, "  V  view navigation mode         <  increase angle step by 10%"
-    print >>f, "  R  reset                        >  decrease angle step by 10%"
-    print >>f, "  H  print this help              ?  print viewpoint"
-    print >>f, "  q  exit"
+    global cmd_table, keystrokes_template, keystrokes_text
+    ensure_keys_loaded ()
+    if keystrokes_text is None:
+        keystrokes_text = keystrokes_template % \
+          dict ((cmd, keys[-1]) for cmd, keys in cmd_table.items ())
+    f.write (keystrokes_text)
+
+def quit_program ():
+    "Exit, once any frames that are being saved have been written out."
+    flush_saved_frames ()
+    sys.exit (0)
+
+# The actions of the NIL-standard keystrokes, indexed by the lower-case key.
+# The step sizes are looked up when the key is pressed, as they can change;
+# rotations use the step already converted to radians.
+step_factor = 1.1        # factor by which "+", "-", "<" and ">" change steps
+key_actions = {
+    "p":    lambda: move_forward (default_step),
+    "l":    lambda: move_forward (-default_step),
+    "z":    lambda: move_left (default_step),
+    "x":    lambda: move_left (-default_step),
+    "u":    lambda: move_up (default_step),
+    "n":    lambda: move_up (-default_step),
+    "+":    lambda: set_translation_step (default_step * step_factor),
+    "-":    lambda: set_translation_step (default_step / step_factor),
+    "<":    lambda: set_rotation_step (default_angle * step_factor),
+    ">":    lambda: set_rotation_step (default_angle / step_factor),
+    "a":    lambda: rotate_horizontally_rad (default_angle_rad),
+    "s":    lambda: rotate_horizontally_rad (-default_angle_rad),
+    "d":    lambda: rotate_vertically_rad (-default_angle_rad),
+    "e":    lambda: rotate_vertically_rad (default_angle_rad),
+    "r":    lambda: reset_viewpoint (),
+    "f":    lambda: fly_mode (),
+    "w":    lambda: walk_mode (),
+    "v":    lambda: view_mode (),
+    "h":    lambda: print_keystrokes (),
+    "?":    lambda: print_location (),
+    "5":    lambda: set_sky ("tropical"),
+    "q":    lambda: quit_program (),
+    "\033": lambda: quit_program (),
+    }
+
+# The actions of the cursor keys.
+special_key_actions = {
+    GLUT_KEY_UP:    lambda: move_forward (default_step),
+    GLUT_KEY_DOWN:  lambda: move_forward (-default_step),
+    GLUT_KEY_LEFT:  lambda: rotate_horizontally_rad (default_angle_rad),
+    GLUT_KEY_RIGHT: lambda: rotate_horizontally_rad (-default_angle_rad),
+    }
 
 def keyboard (key, x, y):
     "Handle keyboard events."
@@ -495,44 +881,24 @@ def keyboard (key, x, y):
     # in addition to the NIL-standard ones.  These keystrokes need to be read
     # from an external file, so that the same ones are available to the NIL
     # keyboard client as well as individual programs.
-    global default_angle, default_step, gsf, keyboard_callback
+    global keyboard_callback, key_actions
+
+    # GLUT hands us the key as a byte.
+    if isinstance (key, bytes): key = key.decode ("latin-1")
 
     # First, see if the program's own keyboard callback handles the key.
     if keyboard_callback and keyboard_callback (key, x, y): return
 
     # The program's keyboard callback didn't handle it so see if we can.
-    fac = 1.1
-    if   key == "p" or key == "P":    move_forward (default_step)
-    elif key == "l" or key == "L":    move_forward (-default_step)
-    elif key == "z" or key == "Z":    move_left (default_step)
-    elif key == "x" or key == "X":    move_left (-default_step)
-    elif key == "u" or key == "U":    move_up (default_step)
-    elif key == "n" or key == "N":    move_up (-default_step)
-    elif key == "+":                  default_step  *= fac
-    elif key == "-":                  default_step  /= fac
-    elif key == "<":                  default_angle *= fac
-    elif key == ">":                  default_angle /= fac
-    elif key == "a" or key == "A":    rotate_horizontally (default_angle)
-    elif key == "s" or key == "S":    rotate_horizontally (-default_angle)
-    elif key == "d" or key == "D":    rotate_vertically (-default_angle)
-    elif key == "e" or key == "E":    rotate_vertically (default_angle)
-    elif key == "r" or key == "R":    reset_viewpoint ()
-    elif key == "f" or key == "F":    fly_mode ()
-    elif key == "w" or key == "W":    walk_mode ()
-    elif key == "v" or key == "V":    view_mode ()
-    elif key == "h" or key == "H":    print_keystrokes ()
-    elif key == "?":                  print_location ()
-    elif key == "5":                  set_sky ("tropical")
-    elif key == "q" or key == "Q" or key == "\033":  sys.exit (0)
+    action = key_actions.get (key.lower ())
+    if action: action ()
     glutPostRedisplay ()
 
 def special (key, x, y):
     "Handle the cursor keys."
-    global default_angle, default_step
-    if   key == GLUT_KEY_UP:     move_forward (default_step)
-    elif key == GLUT_KEY_DOWN:   move_forward (-default_step)
-    elif key == GLUT_KEY_LEFT:   rotate_horizontally (default_angle)
-    elif key == GLUT_KEY_RIGHT:  rotate_horizontally (-default_angle)
+    global special_key_actions
+    action = special_key_actions.get (key)
+    if action: action ()
     glutPostRedisplay ()
 
 def click (button, state, x, y):
@@ -545,28 +911,150 @@ def click (button, state, x, y):
 def mouse (x, y):
     "Move the viewpoint using the mouse."
     global lastx, lasty
-    global default_angle, default_step
-    if x > lastx:    rotate_horizontally (-default_angle)
-    elif x < lastx:  rotate_horizontally (default_angle)
+    global default_angle_rad, default_step
+    if x > lastx:    rotate_horizontally_rad (-default_angle_rad)
+    elif x < lastx:  rotate_horizontally_rad (default_angle_rad)
     if y > lasty:    move_forward (-default_step)
     elif y < lasty:  move_forward (default_step)
     lastx = x
     lasty = y
     glutPostRedisplay ()
 
-def get_num (words, idx, default):
+def get_num (words: List[str], idx: int, default: float) -> float:
     "Parse any number given on a command."
     if len (words) <= idx: return default
     return float (words[idx])
 
+#-------------------------------------------------------------------------------
+# Handlers for the commands read from a script or the network.  Each is passed
+# the command split into words and returns False if the command does not
+# apply to this machine.
+#-------------------------------------------------------------------------------
+def cmd_viewpoint (words):
+    "Set the viewpoint from nine numbers."
+    # We sometimes receive pairs of viewpoint commands in the same packet
+    # (I know not yet why), so reject any commands that don't have exactly
+    # the number of parameters we expect.
+    if len (words) == 10 or len (words) == 11:
+        set_viewpoint (*map (float, words[1:10]))
+
+def cmd_move_forward (words):
+    move_forward (get_num (words, 1, default_step))
+
+def cmd_move_backward (words):
+    move_forward (-get_num (words, 1, default_step))
+
+def cmd_move_left (words):
+    move_left (get_num (words, 1, default_step))
+
+def cmd_move_right (words):
+    move_left (-get_num (words, 1, default_step))
+
+def cmd_move_up (words):
+    move_up (get_num (words, 1, default_step))
+
+def cmd_move_down (words):
+    move_up (-get_num (words, 1, default_step))
+
+def cmd_turn_left (words):
+    rotate_horizontally (-get_num (words, 1, default_angle))
+
+def cmd_turn_right (words):
+    rotate_horizontally (get_num (words, 1, default_angle))
+
+def cmd_turn_down (words):
+    rotate_vertically (-get_num (words, 1, default_angle))
+
+def cmd_turn_up (words):
+    rotate_vertically (get_num (words, 1, default_angle))
+
+def cmd_play_audio (words):
+    "Play an audio file, except on the right-eye machine."
+    if host == "right-server": return False
+    if os.path.isfile(words[1]):
+        os.system ("mpg123 -q " + words[1] + " &")
+    else:
+        say ("File %s doesn't exist!" % words[1])
+
+def cmd_volume (words):
+    "Set the volume, which is done only on the right-eye machine."
+    if host != "right-server": return False
+    v = int( get_num (words, 1, 100))
+    os.system ("amixer -q sset Master %d%%" % v)
+
+def cmd_louder (words):
+    if host != "right-server": return False
+    os.system ("amixer -q sset Master 5%+")
+
+def cmd_quieter (words):
+    if host != "right-server": return False
+    os.system ("amixer -q sset Master 5%-")
+
+def cmd_save_frame (words):
+    global save_frame_number
+    save_frame_number = int (words[1])
+
+def cmd_save_template (words):
+    global save_template
+    save_template = words[1]
+
+def cmd_pause (words):
+    global pause
+    pause = float (words[1])
+
+def cmd_save (words):
+    "Save the current frame, or turn the saving of every frame on or off."
+    if len (words) <= 1:
+        save_frame ()
+    elif words[1] == "on":
+        set_saving_mode (True)
+    elif words[1] == "off":
+        set_saving_mode (False)
+
+def cmd_seed (words):
+    global seed, rng
+    seed = int (words[1])
+    rng = numpy.random.default_rng (seed)
+
+command_handlers = {
+    "viewpoint":       cmd_viewpoint,
+    "move_forward":    cmd_move_forward,
+    "move_backward":   cmd_move_backward,
+    "move_left":       cmd_move_left,
+    "move_right":      cmd_move_right,
+    "move_up":         cmd_move_up,
+    "move_down":       cmd_move_down,
+    "turn_left":       cmd_turn_left,
+    "turn_right":      cmd_turn_right,
+    "turn_down":       cmd_turn_down,
+    "turn_up":         cmd_turn_up,
+    "reset_viewpoint": lambda words: reset_viewpoint (),
+    "fly_mode":        lambda words: fly_mode (),
+    "walk_mode":       lambda words: walk_mode (),
+    "view_mode":       lambda words: view_mode (),
+    "play_audio":      cmd_play_audio,
+    "volume":          cmd_volume,
+    "louder":          cmd_louder,
+    "quieter":         cmd_quieter,
+    "save_frame":      cmd_save_frame,
+    "save_template":   cmd_save_template,
+    "pause":           cmd_pause,
+    "save":            cmd_save,
+    "seed":            cmd_seed,
+    }
+
 def idle ():
     "When there's nothing else to do..."
-    global save_template, pause, gsf, host
+    global pause, save_pending
     global idle_callback, keyboard_callback, command_callback, cmd_table
+    global command_handlers
 
     if idle_callback: idle_callback ()
+    if save_pending: write_pending_frames ()
     if waiting():
-        glutPostRedisplay ()
+        # Keep animations going, but without queueing up frames faster than
+        # the GPU can draw them.
+        if gpu_ready (): glutPostRedisplay ()
         return
     c = command_listener ()
 
@@ -576,7 +1064,7 @@ def idle ():
         print_keystrokes ()
         return
     elif c ==  "quit":
-        sys.exit (0)
+        quit_program ()
 
     # See if this can be handled by the program's command callback.
     if command_callback and c != "" and command_callback (c):
@@ -592,94 +1080,16 @@ def idle ():
     c = words[0]
 
     if keyboard_callback:
+        ensure_keys_loaded ()
         if c in cmd_table:
-            k = cmd_table[c]
+            k = cmd_table[c][-1]
             if keyboard_callback (k, -1, -1):
                 if pause > 0: wait_for (pause)
                 glutPostRedisplay ()
                 return
 
-    if c == "viewpoint":
-        # We sometimes receive pairs of viewpoint commands in the same packet
-        # (I know not yet why), so reject any commands that don't have exactly
-        # the number of parameters we expect.
-        if len (words) == 10 or len (words) == 11:
-            CX = float (words[1])
-            CY = float (words[2])
-            CZ = float (words[3])
-            VX = float (words[4])
-            VY = float (words[5])
-            VZ = float (words[6])
-            UX = float (words[7])
-            UY = float (words[8])
-            UZ = float (words[9])
-            set_viewpoint (CX, CY, CZ, VX, VY, VZ, UX, UY, UZ)
-    elif c ==  "move_forward":
-        v = get_num (words, 1, default_step)
-        move_forward (v)
-    elif c ==  "move_backward":
-        v = get_num (words, 1, default_step)
-        move_forward (-v)
-    elif c ==  "move_left":
-        v = get_num (words, 1, default_step)
-        move_left (v)
-    elif c ==  "move_right":
-        v = get_num (words, 1, default_step)
-        move_left (-v)
-    elif c ==  "move_up":
-        v = get_num (words, 1, default_step)
-        move_up (v)
-    elif c ==  "move_up":
-        v = get_num (words, 1, default_step)
-        move_up (-v)
-    elif c ==  "turn_left":
-        v = get_num (words, 1, default_ang)
-        rotate_horizontally (-v)
-    elif c ==  "turn_right":
-        v = get_num (words, 1, default_ang)
-        rotate_horizontally (v)
-    elif c ==  "turn_down":
-        v = get_num (words, 1, default_ang)
-        rotate_vertically (-v)
-    elif c ==  "turn_up":
-        v = get_num (words, 1, default_ang)
-        rotate_vertically (v)
-    elif c == "reset_viewpoint":
-        reset_viewpoint ()
-    elif c == "fly_mode":
-        fly_mode ()
-    elif c == "walk_mode":
-        walk_mode ()
-    elif c == "view_mode":
-        view_mode ()
-    elif c == "play_audio" and host != "right-server":
-        if os.path.isfile(words[1]):
-            os.system ("mpg123 -q " + words[1] + " &")
-        else:
-            say ("File %s doesn't exist!" % words[1])
-    elif c == "volume" and host == "right-server":
-        v = int( get_num (words, 1, 100))
-        os.system ("amixer -q sset Master %d%%" % v)
-    elif c == "louder" and host == "right-server":
-        os.system ("amixer -q sset Master 5%+")
-    elif c == "quieter" and host == "right-server":
-        os.system ("amixer -q sset Master 5%-")
-    elif c == "save_frame":
-        save_frame_number = int (words[1])
-    elif c == "save_template":
-        save_template = words[1]
-    elif c == "pause":
-        pause = float (words[1])
-    elif c == "save":
-        if len (words) <= 1:
-            save ()
-        elif words[1] == "on":
-            set_saving_mode (True)
-        elif words[1] == "off":
-            set_saving_mode (False)
-    elif c == "seed":
-        seed = int (words[1])
-    else:
+    handler = command_handlers.get (c)
+    if handler is None or handler (words) is False:
         return
 
     if pause > 0: wait_for (pause)
@@ -723,6 +1133,8 @@ def init (args):
           help="x-position of window when not operating full-screen")
     parser.add_argument ("-Y", type=int,
           help="y-position of window when not operating full-screen")
+    parser.add_argument ("-debug", action="store_true",
+          help="check the framebuffer is ready before starting")
 
     # A program is invoked with "-net" or "-play" (with a script) or nothing.
     group = parser.add_mutually_exclusive_group()
@@ -731,13 +1143,16 @@ def init (args):
     group.add_argument ("-play", help="take commands from the specified file")
     nil_args = parser.parse_args (args[1:])
 
+    # Read the keymap now, so that it is there before any callback runs.
+    ensure_keys_loaded ()
+
     # Remember the duration of any pause.
     pause = nil_args.pause
 
     # Determine whether we are running on a NIL machine and set up the
     # transformation relative to the right eye.
     host = socket.gethostname ()
-    if all_gtms.has_key (host): gtm = all_gtms[host]
+    if host in all_gtms: gtm = all_gtms[host]
 
     # Set up the display, depending on which machine we are on and whether or
     # not we have been told to run in a window rather than full-screen.
@@ -765,14 +1180,22 @@ def init (args):
            
             width = glutGet (GLUT_WINDOW_WIDTH)
 
-    # Wait for the framebuffer to become available before continuing.
-    have_waited = False
-    while True:
-        if glCheckFramebufferStatus (GL_FRAMEBUFFER): break
-        print "Z",
-        have_waited = True
-        time.sleep(1)
-    if have_waited: print
+    # GLUT hands us a usable default framebuffer once the window exists, so
+    # check it only when "-debug" is given, as the query stalls the GPU.  A
+    # status of zero means it is not yet available: wait a millisecond and
+    # then ever longer, up to a tenth of a second, and after a second or two
+    # just warn and carry on.
+    if nil_args.debug:
+        delay = 0.001
+        tries = 0
+        while not glCheckFramebufferStatus (GL_FRAMEBUFFER):
+            tries += 1
+            if tries > 20:
+                print ("[framebuffer still not available; continuing]",
+                       file=sys.stderr)
+                break
+            time.sleep (delay)
+            delay = min (delay * 2, 0.1)
 
     # Set up saving frames if the command-line qualifier was present.
     if nil_args.save: set_saving_mode (True)
@@ -786,21 +1209,25 @@ def init (args):
 def command_listener_begin ():
     """Set things up to read commands from a file or the network, depending on
     the command line."""
-    global read_list, command_stream, nil_args, host
+    global read_list, command_stream, command_poller, nil_args, host
 
     if nil_args.play:
         command_stream = open (nil_args.play)
-        print >>sys.stderr,  "[reading from file %s]" % nil_args.play
+        print ("[reading from file %s]" % nil_args.play, file=sys.stderr)
     elif nil_args.net:
         hn, port = nil_args.controller, nil_args.port
         command_stream = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+        command_stream.setsockopt (socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   command_rcvbuf)
         command_stream.connect ((hn, port))
         command_stream.setblocking (0)
         read_list = [command_stream]
-        print >>sys.stderr,  "\r[%s: connected to %s on port %d]\r" % \
-          (host, hn, port)
+        command_poller = make_poller (command_stream)
+        print ("\r[%s: connected to %s on port %d]\r" % (host, hn, port),
+               file=sys.stderr)
     else:
-        print >>sys.stderr, "[taking commands from your keyboard and mouse]"
+        print ("[taking commands from your keyboard and mouse]",
+               file=sys.stderr)
         print_keystrokes (sys.stderr)
 
 def command_listener ():
@@ -817,79 +1244,174 @@ def command_listener ():
             command_listener_end ()
             nil_args.play = False
     elif nil_args.net:
-        try:
-            data = command_stream.recv(4096)
-        except socket.error, e:
-            err = e.args[0]
-            if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                return ""
-        if data:
+        # Only touch the socket when the poller says there is something to
+        # read; otherwise hand back any command left over from an earlier
+        # read, which may have brought in several.
+        if not command_pending and command_ready ():
+            drain_command_stream ()
+        if command_pending:
+            data = command_pending.popleft ()
+            # A viewpoint command replaces the whole viewpoint, so when a run
+            # of them has built up, only the latest need be acted upon; this
+            # stops a client that has fallen behind from lagging the others.
+            while data.startswith ("viewpoint ") and command_pending and \
+                  command_pending[0].startswith ("viewpoint "):
+                data = command_pending.popleft ()
             if data == "quit":
-                print "\r[Exiting]\r"
+                print ("\r[Exiting]\r")
                 command_listener_end ()
                 exit (0)
-        return data
+            return data
     return ""
 
+def make_poller (sock):
+    """Return a poller watching sock for input.  We use edge-triggered epoll
+    where it is available (Linux), falling back to poll elsewhere."""
+    if hasattr (select, "epoll"):
+        poller = select.epoll ()
+        poller.register (sock.fileno (), select.EPOLLIN | select.EPOLLET)
+    else:
+        poller = select.poll ()
+        poller.register (sock.fileno (), select.POLLIN)
+    return poller
+
+def command_ready (timeout=0):
+    """Say whether the controller has sent us anything, waiting at most
+    timeout seconds for it to do so."""
+    global command_poller
+    if command_poller is None: return True
+    if hasattr (select, "epoll"):
+        return len (command_poller.poll (timeout)) > 0
+    return len (command_poller.poll (timeout * 1000)) > 0   # milliseconds
+
+def drain_command_stream ():
+    """Read everything the controller has sent us and queue the complete,
+    newline-terminated commands in it.  With an edge-triggered poller we are
+    told only once about newly-arrived data, so we must keep reading until
+    the socket is empty: a read that does not fill the buffer shows that it
+    is, and saves a further read that would fail."""
+    global command_stream, command_partial, command_buffer
+    # Reading into the same buffer every time avoids allocating a new one for
+    # each read; only what actually arrived is copied out of it.
+    flags = getattr (socket, "MSG_DONTWAIT", 0)
+    view = memoryview (command_buffer)
+    while True:
+        try:
+            n = command_stream.recv_into (command_buffer, len (command_buffer),
+                                          flags)
+        except socket.error as e:
+            err = e.args[0]
+            if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
+                break
+            raise
+        if n == 0:
+            # The controller has closed the connection, so whatever it sent
+            # last is complete even without a newline.
+            command_partial += b"\n"
+            break
+        command_partial += view[:n]
+        if n < len (command_buffer): break
+    split_commands ()
+
+def split_commands ():
+    """Move the complete lines received from the controller to the queue of
+    commands, leaving any incomplete one at the end to be finished later."""
+    global command_pending, command_partial
+    end = command_partial.rfind (b"\n")
+    if end < 0: return
+    lines = command_partial[:end].decode ("latin-1").split ("\n")
+    del command_partial[:end + 1]
+    for line in lines:
+        line = line.strip ()
+        if line: command_pending.append (line)
+
 def command_listener_end ():
     "Close off any input stream we're reading commands from."
-    global read_list, command_stream, nil_args
+    global read_list, command_stream, command_poller, nil_args
 
+    flush_saved_frames ()
     if nil_args.play:
         command_stream.close ()
     elif nil_args.net:
+        if command_poller is not None:
+            command_poller.close ()
+            command_poller = None
         for s in read_list:
             s.close ()
 
+# Where to look for a keyboard map that is not in the current directory.
+key_search_path = [d for d in [os.environ.get ("NILGL_KEYMAP_DIR"),
+                               os.path.dirname (os.path.abspath (__file__))]
+                   if d and os.path.isdir (d)]
+
+keys_loaded = False      # whether the default keymap, nil.kbd, has been read
+
+def ensure_keys_loaded ():
+    "Load the default keymap, unless that has already been done."
+    global keys_loaded
+    if not keys_loaded:
+        keys_loaded = True
+        load_keys ("nil.kbd")
+
 def load_keys (fn):
     "Load a keyboard map from a file.  Lines have the format 'k k...: cmd'."
-    global key_table, cmd_table
-    # Open the file and read it a line at a time.
-    found = False
-    for dir in ["", "./", "/Users/alien/work/models/clients/",
-                "/home/alien/",
-                "./"]:
-        ffn = dir + fn
-        if os.path.exists (ffn):
-            found = True
-            break
-    if not found:
-        print >>sys.stderr, "Keyboard mapping file %s not found." % fn
-        return
+    global key_table, cmd_table, keystrokes_text
+    # Any other keymap is laid over the default one, so read that first.
+    ensure_keys_loaded ()
+    # Look for the file as named, then in each directory of the search path.
+    ffn = fn
+    if not os.path.exists (ffn):
+        for d in key_search_path:
+            ffn = os.path.join (d, fn)
+            if os.path.exists (ffn): break
+        else:
+            print ("Keyboard mapping file %s not found." % fn, file=sys.stderr)
+            return
 
+    keystrokes_text = None   # the help text must reflect the new keys
     f = open (ffn)
-    for line in f:
+    lines = f.read ().splitlines ()
+    f.close()
+    for line in lines:
         # Strip leading and trailing whitespace, ignore blanks and comments.
         line = line.strip ()
         if len (line) < 1: continue
         if line[0] == "#": continue
         # Pull out the keys and corresponding command, storing the result.
-        k, cmd = line.split (":")
+        k, cmd = line.split (":", 1)
         cmd = cmd.strip ()
         keys = k.split ()
+        cmd_table[cmd] = tuple (keys)
         for k in keys:
-            cmd_table[cmd] = k
             key_table[k] = cmd
-    f.close()
 
 #-------------------------------------------------------------------------------
 # Convenience routines for loading textures and an all-encompassing skybox.
 #-------------------------------------------------------------------------------
+texture_cache = {}       # textures already loaded, keyed by (path, mipmap)
+
 def load_texture (path, mipmap=False):
-    "Given an image in path, load it and convert it into an OpenGL texture."
+    """Given an image in path, load it and convert it into an OpenGL texture.
+    An image that has been loaded before returns the same texture."""
     glClearColor (0.3,0.3,0.3,1.0)
     glEnable (GL_DEPTH_TEST)
 
+    key = (os.path.abspath (path), mipmap)
+    if key in texture_cache: return texture_cache[key]
     image = Image.open(path)
     (width, height) = image.size[0:2]
+    # Get at the pixels as an array, which OpenGL can read directly: RGBA
+    # images are turned upside down and lose their alpha channel, and grey
+    # levels are repeated for each of red, green and blue.
     if image.mode == "RGB":
-        pixel_data = image.tobytes ()
+        pixel_data = numpy.asarray (image)
     elif image.mode == "RGBA":
-        pixel_data = image.tobytes ("raw", "RGB", 0, -1)
+        pixel_data = numpy.ascontiguousarray (numpy.asarray (image)[::-1,:,:3])
     elif image.mode == "L":
-        pixel_data = image.convert("RGBA").tobytes ("raw", "RGB")
+        pixel_data = numpy.repeat (numpy.asarray (image)[:,:,None], 3, axis=2)
     else:
-        print >>sys.stderr, "Unsupported image mode", image.mode, "for", path
+        print ("Unsupported image mode", image.mode, "for", path,
+               file=sys.stderr)
         sys.exit (1)
     texture = glGenTextures (1)
     glPixelStorei (GL_UNPACK_ALIGNMENT, 1)
@@ -902,23 +1424,79 @@ def load_texture (path, mipmap=False):
                          GL_LINEAR_MIPMAP_LINEAR)
         glTexParameterf (GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER,
                          GL_LINEAR)
-        gluBuild2DMipmaps(GL_TEXTURE_2D, GL_RGBA, width, height, GL_RGB,
-                     GL_UNSIGNED_BYTE, pixel_data)
+        # Upload just the full-size image and have the GPU build the
+        # smaller levels from it, where the driver lets us.  That cannot be
+        # compiled into a display list, though: glGenerateMipmap would run
+        # straight away, and the list would hold only the full-size image.
+        if bool (glGenerateMipmap) and glGetIntegerv (GL_LIST_INDEX) == 0:
+            upload_texture_image (GL_RGBA, width, height, pixel_data)
+            glGenerateMipmap (GL_TEXTURE_2D)
+        else:
+            gluBuild2DMipmaps(GL_TEXTURE_2D, GL_RGBA, width, height, GL_RGB,
+                              GL_UNSIGNED_BYTE, pixel_data)
     else:
         glTexParameteri (GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
         glTexParameteri (GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
         glTexParameteri (GL_TEXTURE_2D, GL_TEXTURE_WRAP_R, GL_REPEAT)
         glTexParameteri (GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
         glTexParameteri (GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, width, height, 0, GL_RGB,
-                     GL_UNSIGNED_BYTE, pixel_data)
+        upload_texture_image (GL_RGB, width, height, pixel_data)
     glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_REPLACE)
+    texture_cache[key] = texture
     return texture
 
+def upload_texture_image (internal_format, width, height, pixel_data):
+    """Load an array of RGB pixels into the base level of the bound texture.
+    Where we can, they go through a pixel unpack buffer, so that the driver
+    can copy them to the GPU without holding us up; but not while a display
+    list is being compiled, as the buffer would be gone before it was run."""
+    if not bool (glGenBuffers) or glGetIntegerv (GL_LIST_INDEX) != 0:
+        glTexImage2D(GL_TEXTURE_2D, 0, internal_format, width, height, 0,
+                     GL_RGB, GL_UNSIGNED_BYTE, pixel_data)
+        return
+    pbo = glGenBuffers (1)
+    glBindBuffer (GL_PIXEL_UNPACK_BUFFER, pbo)
+    glBufferData (GL_PIXEL_UNPACK_BUFFER, pixel_data.nbytes, pixel_data,
+                  GL_STREAM_DRAW)
+    glTexImage2D(GL_TEXTURE_2D, 0, internal_format, width, height, 0,
+                 GL_RGB, GL_UNSIGNED_BYTE, ctypes.c_void_p (0))
+    glBindBuffer (GL_PIXEL_UNPACK_BUFFER, 0)
+    glDeleteBuffers (1, [pbo])
+
 available_skyboxes = ["mono", "default", "cloudy", "cloudrays",
                       "stormy", "tropical", "sunset", "moonlit"]
 skyboxsize = 1000        # half-size of any skybox that we draw
-skybox = []              # the textures, when loaded
+sky_cache = {}           # the (face, texture) pairs loaded for each type of sky
+sky_vbo = None           # the buffer object holding sky_array on the GPU
+sky_capabilities = (GL_TEXTURE_2D, GL_DEPTH_TEST, GL_LIGHTING, GL_BLEND)
+
+# The texture images for each face of a skybox, in the order of sky_faces.
+sky_images = ['front', 'left', 'back', 'right', 'top', 'bottom']
+
+# The texture coordinates and vertices (s, t, x, y, z) of the faces of a unit
+# skybox, in the same order as sky_images.  One thing to remember
+# is that OpenGL measures its coordinates from the LOWER left coordinate of
+# the image; hence, the t-values are the converse from what the geometry
+# suggests.  This avoids us having to remember to store images upside down
+# for use in texture maps.  All of the faces are ordered anticlockwise from
+# the bottom left.  The comments name the side of the box each face is on;
+# as always, the "left" image goes on the right (+x) side and the "right"
+# image on the left, which the existing skybox images rely on.
+sky_faces = [
+    [(0, 1, -1, -1, -1), (1, 1,  1, -1, -1),     # front
+     (1, 0,  1,  1, -1), (0, 0, -1,  1, -1)],
+    [(0, 1,  1, -1, -1), (1, 1,  1, -1,  1),     # right side, "left" image
+     (1, 0,  1,  1,  1), (0, 0,  1,  1, -1)],
+    [(0, 1,  1, -1,  1), (1, 1, -1, -1,  1),     # back
+     (1, 0, -1,  1,  1), (0, 0,  1,  1,  1)],
+    [(0, 1, -1, -1,  1), (1, 1, -1, -1, -1),     # left side, "right" image
+     (1, 0, -1,  1, -1), (0, 0, -1,  1,  1)],
+    [(1, 1, -1,  1, -1), (0, 1, -1,  1,  1),     # top
+     (0, 0,  1,  1,  1), (1, 0,  1,  1, -1)],
+    [(0, 0, -1, -1, -1), (0, 1, -1, -1,  1),     # bottom
+     (1, 1,  1, -1,  1), (1, 0,  1, -1, -1)],
+]
+sky_array = numpy.array (sky_faces, dtype=numpy.float32).reshape (-1, 5)
 
 def set_sky (box="default"):
     "Set the skybox to use."
@@ -927,7 +1505,7 @@ def set_sky (box="default"):
         if b == box:
             sky = box
             return
-    print >>sys.stderr, "Skybox called", box, "is not supported."
+    print ("Skybox called", box, "is not supported.", file=sys.stderr)
     box = "default"
 
 def get_sky ():
@@ -938,160 +1516,179 @@ def get_sky ():
 def draw_sky (type="default", dir=["./skybox",
                                    "/Users/alien/work/models/skybox"]):
     "Draw an all-encompassing box with a sky texture mapped onto it."
-    global skybox, skyboxsize
-    if len (skybox) == 0:
-        # Load the textures for the enclosing sky box.
-        for f in ['front', 'left', 'back', 'right', 'top', 'bottom']:
+    global sky_cache, skyboxsize, sky_vbo
+    skybox = sky_cache.get (type)
+    if skybox is None:
+        # Load the textures for the enclosing sky box, remembering which face
+        # each is for in case some are missing.
+        skybox = []
+        for i, f in enumerate (sky_images):
             fn = "sky_%s_%s.jpg" % (type, f)
             for d in dir:
                 ffn = os.path.join (d, fn)
                 if os.path.exists (ffn):
-                    tim = load_texture (ffn)
-                    skybox += [tim]
+                    skybox.append ((i, load_texture (ffn)))
                     break
+        sky_cache[type] = skybox
         if len(skybox) == 0:
-            print >>sys.stderr, "Alas, no skybox textures could be found."
-            return
+            print ("Alas, no skybox textures could be found.",
+                   file=sys.stderr)
+    if len (skybox) == 0: return
+
+    if sky_vbo is None:
+        # Put the faces into a buffer on the GPU, which serves every type of
+        # sky; without buffer objects, they are drawn from our memory.
+        sky_vbo = 0
+        if bool (glGenBuffers):
+            sky_vbo = glGenBuffers (1)
+            glBindBuffer (GL_ARRAY_BUFFER, sky_vbo)
+            glBufferData (GL_ARRAY_BUFFER, sky_array.nbytes, sky_array,
+                          GL_STATIC_DRAW)
+            glBindBuffer (GL_ARRAY_BUFFER, 0)
+
+    # Note which of the capabilities we change were enabled, to put them back
+    # afterwards.  glIsEnabled cannot see the state a display list will be
+    # run in, though, so while one is being compiled GL has to save them.
+    compiling = glGetIntegerv (GL_LIST_INDEX) != 0
+    if compiling:
+        glPushAttrib (GL_ENABLE_BIT)
+    else:
+        enabled = [(cap, glIsEnabled (cap)) for cap in sky_capabilities]
 
     d = skyboxsize
     glPushMatrix ()
-    glPushAttrib (GL_ENABLE_BIT)
     glEnable (GL_TEXTURE_2D)
     glDisable (GL_DEPTH_TEST)
     glDisable (GL_LIGHTING)
     glDisable (GL_BLEND)
     glColor4f (1.0, 1.0, 1.0, 1.0)
+    glScalef (d, d, d)
+
+    # sky_array is laid out just as GL_T2F_V3F expects, so one call sets
+    # up both the texture coordinates and the vertices; it changes the other
+    # vertex arrays too, so the caller's are saved and put back afterwards,
+    # along with the caller's array buffer binding.
+    glPushClientAttrib (GL_CLIENT_VERTEX_ARRAY_BIT)
+    if sky_vbo:
+        glBindBuffer (GL_ARRAY_BUFFER, sky_vbo)
+        glInterleavedArrays (GL_T2F_V3F, 0, ctypes.c_void_p (0))
+    else:
+        glInterleavedArrays (GL_T2F_V3F, 0, sky_array)
+    for i, texture in skybox:
+        glBindTexture (GL_TEXTURE_2D, texture)
+        glDrawArrays (GL_QUADS, 4 * i, 4)
+    glPopClientAttrib ()
 
-    # One thing to remember is that OpenGL measures its coordinates from the
-    # LOWER left coordinate of the image; hence, the y-values in the calls to
-    # glTexCoord2f are the converse from what the geometry suggests.  This
-    # avoids us having to remember to store images upside down for use in
-    # texture maps.  All of the following are ordered anticlockwise from the
-    # bottom left.
-    glBindTexture (GL_TEXTURE_2D, skybox[0])  # front
-    glBegin (GL_QUADS)
-    glTexCoord2f (0, 1); glVertex3f (-d, -d, -d)
-    glTexCoord2f (1, 1); glVertex3f ( d, -d, -d)
-    glTexCoord2f (1, 0); glVertex3f ( d,  d, -d)
-    glTexCoord2f (0, 0); glVertex3f (-d,  d, -d)
-    glEnd ()
-
-    glBindTexture (GL_TEXTURE_2D, skybox[3])  # left
-    glBegin (GL_QUADS)
-    glTexCoord2f (0, 1); glVertex3f (-d, -d,  d)
-    glTexCoord2f (1, 1); glVertex3f (-d, -d, -d)
-    glTexCoord2f (1, 0); glVertex3f (-d,  d, -d)
-    glTexCoord2f (0, 0); glVertex3f (-d,  d,  d)
-    glEnd ()
-
-    glBindTexture (GL_TEXTURE_2D, skybox[2])  # back
-    glBegin (GL_QUADS)
-    glTexCoord2f (0, 1); glVertex3f ( d, -d,  d)
-    glTexCoord2f (1, 1); glVertex3f (-d, -d,  d)
-    glTexCoord2f (1, 0); glVertex3f (-d,  d,  d)
-    glTexCoord2f (0, 0); glVertex3f ( d,  d,  d)
-    glEnd ()
-
-    glBindTexture (GL_TEXTURE_2D, skybox[1])  # right
-    glBegin (GL_QUADS)
-    glTexCoord2f (0, 1); glVertex3f ( d, -d, -d)
-    glTexCoord2f (1, 1); glVertex3f ( d, -d,  d)
-    glTexCoord2f (1, 0); glVertex3f ( d,  d,  d)
-    glTexCoord2f (0, 0); glVertex3f ( d,  d, -d)
-    glEnd ()
-
-    glBindTexture (GL_TEXTURE_2D, skybox[4])  # top
-    glBegin (GL_QUADS)
-    glTexCoord2f (1, 1); glVertex3f (-d,  d, -d)
-    glTexCoord2f (0, 1); glVertex3f (-d,  d,  d)
-    glTexCoord2f (0, 0); glVertex3f ( d,  d,  d)
-    glTexCoord2f (1, 0); glVertex3f ( d,  d, -d)
-    glEnd ()
-
-    glBindTexture (GL_TEXTURE_2D, skybox[5])  # bottom
-    glBegin (GL_QUADS)
-    glTexCoord2f (0, 0); glVertex3f ( -d, -d, -d)
-    glTexCoord2f (0, 1); glVertex3f ( -d, -d,  d)
-    glTexCoord2f (1, 1); glVertex3f (  d, -d,  d)
-    glTexCoord2f (1, 0); glVertex3f (  d, -d, -d)
-    glEnd ()
-
-    glPopAttrib ()
     glPopMatrix ()
+    if compiling:
+        glPopAttrib ()
+    else:
+        for cap, on in enabled:
+            if on: glEnable (cap)
+            else:  glDisable (cap)
 
 #-------------------------------------------------------------------------------
 # Miscellaneous routines.
 #-------------------------------------------------------------------------------
 def rad (a):
-    "Convert degrees to radians."
-    return a * pi / 180.0
+    "Convert degrees to radians (multiplying by deg2rad is quicker)."
+    return a * deg2rad
 
 def deg (a):
-    "Convert radians to degrees."
-    return a * 180.0 / pi
+    "Convert radians to degrees (multiplying by rad2deg is quicker)."
+    return a * rad2deg
 
 def dcos (a):
     "Cosine of an angle in degrees."
-    return cos (rad (a))
+    return cos (a * deg2rad)
 
 def dsin (a):
     "Sine of an angle in degrees."
-    return sin (rad (a))
+    return sin (a * deg2rad)
+
+found_in_path = {}       # the results of find_in_path, keyed by program
 
 def find_in_path (prog):
-    "Return the absolute pathname of a program which is in the search path."
+    """Return the absolute pathname of a program which is in the search path.
+    The answer is remembered for the rest of the run."""
+    if prog in found_in_path: return found_in_path[prog]
     # First, split the PATH variable into a list of directories, then find
     # the first program from our list that is in the path.
-    path = string.split(os.environ['PATH'], os.pathsep)
-    for p in path:
+    found_in_path[prog] = None
+    for p in os.environ['PATH'].split (os.pathsep):
         fp = os.path.join(p, prog)
-        if os.path.exists(fp): return os.path.abspath(fp)
-    return None
+        if os.path.exists(fp):
+            found_in_path[prog] = os.path.abspath(fp)
+            break
+    return found_in_path[prog]
 
-def say (text, async=False):
+# The speech synthesizer used by say, if there is one.
+tts_cmd = find_in_path ('say') or find_in_path ('flite')
+
+def say (text, async_=False):
     "Output some text via the system's speech synthesizer"
     if host == "left-server": return  # no sound output on this computer
-    if find_in_path ('say'):
-        if async: os.system ('say ' + text + '&')
-        else: os.system ('say ' + text)
-    elif find_in_path ('flite'):
-        os.system ('flite " ' + text + '" &> /dev/null')
+    if tts_cmd is None:
+        print (text, file=sys.stderr)
+    elif os.path.basename (tts_cmd) == 'say':
+        p = subprocess.Popen ([tts_cmd, text], close_fds=True)
+        if not async_: p.wait ()
     else:
-        print >>sys.stderr, text
-
-def wait_for (delay):
-    """Set up a busy-wait until <when>.  This is used principally to allow
-    animations to play."""
+        # flite is chatty, and was always left to speak in the background.
+        subprocess.Popen ([tts_cmd, text], stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL, close_fds=True)
+
+def wait_for (delay, callback=None):
+    """Set up a busy-wait for delay seconds.  This is used principally to
+    allow animations to play.  Animations should prefer to pass a callback,
+    which GLUT calls once the time is up, rather than polling waiting ()."""
     global wait_until
-    wait_until = time.time () + delay
+    wait_until = time.monotonic () + delay
+    if callback is not None:
+        glutTimerFunc (int (delay * 1000), lambda value: callback (), 0)
 
 def waiting ():
-    "Say whether we are currently busy-waiting."
+    """Say whether we are currently busy-waiting.  Rather than spinning flat
+    out, each call blocks for at most a millisecond so that the idle
+    callback, and hence any animation, keeps running."""
     global wait_until
 
-    if time.time () < wait_until:
-        return True
-    return False
+    remaining = wait_until - time.monotonic ()
+    if remaining <= 0:
+        return False
+    idle_wait (min (remaining, 0.001))
+    return True
+
+def idle_wait (timeout):
+    """Block for up to timeout seconds, returning early if a command arrives
+    from the controller."""
+    global command_poller
+    if command_poller is None:
+        time.sleep (timeout)
+    elif command_ready (timeout):
+        # The poller reports new input only once, so read it now.
+        drain_command_stream ()
 
 #-------------------------------------------------------------------------------
 # Graphics routines.
 #-------------------------------------------------------------------------------
 
+# These work on a single vector or on an (N, 3) array of them, returning
+# numpy arrays.
+
 def vector_product (xyz1, xyz2):
     "Calculate the vector product of two vectors"
-    x = xyz1[1] * xyz2[2] - xyz1[2] * xyz2[1]
-    y = xyz1[2] * xyz2[0] - xyz1[0] * xyz2[2]
-    z = xyz1[0] * xyz2[1] - xyz1[1] * xyz2[0]
-    return (x, y, z)
+    return numpy.cross (xyz1, xyz2)
 
 def veclen (xyz):
     "Find the length of a vector"
-    return sqrt (xyz[0]**2 + xyz[1]**2 + xyz[2]**2)
+    return numpy.linalg.norm (xyz, axis=-1)
 
 def normalize (xyz):
     "Normalize a vector"
-    size = veclen (xyz)
-    return (xyz[0]/size,  xyz[1]/size, xyz[2]/size)
+    return xyz / numpy.linalg.norm (xyz, axis=-1, keepdims=True)
+
+cylinder_lists = {}      # display lists of unit cylinders, keyed by shape
 
 def cylinder (xyz1, xyz2, r, sides=8, a1=0, a2=360, closed=True):
     """Output the definition of a cylinder of radius r with ends at
@@ -1099,73 +1696,74 @@ def cylinder (xyz1, xyz2, r, sides=8, a1=0, a2=360, closed=True):
 
     Adapted from models.py"""
     # Start by creating a vector from one end to the other.
-    vx = xyz1[0] - xyz2[0]
-    vy = xyz1[1] - xyz2[1]
-    vz = xyz1[2] - xyz2[2]
-    axis = [vx, vy, vz]
+    xyz1 = numpy.asarray (xyz1, dtype=float)
+    xyz2 = numpy.asarray (xyz2, dtype=float)
+    axis = xyz1 - xyz2
     r1 = r2 = r   # as the models routine is for a cone
 
     # Find two perpendicular vectors, p and q, in the plane of the disk and
     # ensure they're normalized.  We get the first by knowing that its
     # scalar product with axis must be zero; there are three cases in case
     # any of the components are zero.
-    perp = [vx, vy, vz]
-    if vx == 0 and vz == 0: perp[0] += 1
-    else:                   perp[1] += 1
+    perp = axis.copy ()
+    if axis[0] == 0 and axis[2] == 0: perp[0] += 1
+    else:                             perp[1] += 1
     q = vector_product (perp, axis)
-    perp = vector_product (axis, q)
-    perp = normalize (perp)
+    perp = normalize (vector_product (axis, q))
     q = normalize (q)
 
+    # Unless we are in the middle of compiling a display list, draw a unit
+    # cylinder of this shape from a display list of its own, transformed to
+    # lie between xyz1 and xyz2: its x and y axes map onto perp and q scaled
+    # by the radius, and its z axis from 0 to 1 onto xyz2 to xyz1.
+    if glGetIntegerv (GL_LIST_INDEX) != 0:
+        draw_cylinder (xyz1, xyz2, perp, q, r1, r2, sides, a1, a2, closed)
+        return
+    shape = (sides, a1, a2, closed)
+    if shape not in cylinder_lists:
+        cylinder_lists[shape] = glGenLists (1)
+        glNewList (cylinder_lists[shape], GL_COMPILE)
+        draw_cylinder (numpy.array ((0.0, 0.0, 1.0)), numpy.zeros (3),
+                       numpy.array ((1.0, 0.0, 0.0)),
+                       numpy.array ((0.0, 1.0, 0.0)),
+                       1, 1, sides, a1, a2, closed)
+        glEndList ()
+    m = numpy.identity (4)
+    m[:3,0] = r * perp
+    m[:3,1] = r * q
+    m[:3,2] = axis
+    m[:3,3] = xyz2
+    glPushMatrix ()
+    glMultMatrixf (m.T.ravel ())   # OpenGL wants it column by column
+    glCallList (cylinder_lists[shape])
+    glPopMatrix ()
+
+def draw_cylinder (xyz1, xyz2, perp, q, r1, r2, sides, a1, a2, closed):
+    """Draw the cylinder (or cone) set up by cylinder, given as numpy
+    arrays its ends and the perpendicular unit vectors from which its
+    rim is made."""
+    # Work out the points around both ends of the cone at once, one row per
+    # angle, so that the last row closes the last side.
+    ainc = (a2 - a1) * deg2rad / sides
+    angs = a1 * deg2rad + numpy.arange (sides + 1) * ainc
+    n = normalize (numpy.outer (numpy.cos (angs), perp) +
+                   numpy.outer (numpy.sin (angs), q))
+    p1 = xyz1 + r1 * n
+    p2 = xyz2 + r2 * n
+
     # Define the polygons that form the sides (and optionally the ends)
-    # of the cone.
-    ainc = (a2 - a1) / sides * pi / 180.0
-    alo = a1 * pi / 180.0
-    for i in range (0, sides):
-        ang = alo + i * ainc
-        nx = cos(ang) * perp[0] + sin(ang) * q[0]
-        ny = cos(ang) * perp[1] + sin(ang) * q[1]
-        nz = cos(ang) * perp[2] + sin(ang) * q[2]
-        n = normalize ((nx, ny, nz))
-        p2x = xyz2[0] + r2 * n[0]
-        p2y = xyz2[1] + r2 * n[1]
-        p2z = xyz2[2] + r2 * n[2]
-        p1x = xyz1[0] + r1 * n[0]
-        p1y = xyz1[1] + r1 * n[1]
-        p1z = xyz1[2] + r1 * n[2]
-
-        ang += ainc
-        nx = cos(ang) * perp[0] + sin(ang) * q[0]
-        ny = cos(ang) * perp[1] + sin(ang) * q[1]
-        nz = cos(ang) * perp[2] + sin(ang) * q[2]
-        n = normalize ((nx, ny, nz))
-        q1x = xyz1[0] + r1 * n[0]
-        q1y = xyz1[1] + r1 * n[1]
-        q1z = xyz1[2] + r1 * n[2]
-        q2x = xyz2[0] + r2 * n[0]
-        q2y = xyz2[1] + r2 * n[1]
-        q2z = xyz2[2] + r2 * n[2]
-
-        glBegin (GL_QUADS)
-        glVertex3f (p2x, p2y, p2z)
-        glVertex3f (p1x, p1y, p1z)
-        glVertex3f (q1x, q1y, q1z)
-        glVertex3f (q2x, q2y, q2z)
-        glEnd ()
-
-        # If the cone is closed, draw part of the end-caps.
-        if closed:
-            glBegin (GL_POLYGON)
-            glVertex3f (xyz1[0], xyz1[1], xyz1[2])
-            glVertex3f (p1x, p1y, p1z)
-            glVertex3f (q1x, q1y, q1z)
-            glEnd ()
-            
-            glBegin (GL_POLYGON)
-            glVertex3f (xyz2[0], xyz2[1], xyz2[2])
-            glVertex3f (p2x, p2y, p2z)
-            glVertex3f (q2x, q2y, q2z)
-            glEnd ()
+    # of the cone, as quads followed by a triangle fan for each end-cap.
+    quads = numpy.stack ((p2[:-1], p1[:-1], p1[1:], p2[1:]), axis=1)
+    verts = numpy.concatenate ((quads.reshape (-1, 3), xyz1[None], p1,
+                                xyz2[None], p2)).astype (numpy.float32)
+    glPushClientAttrib (GL_CLIENT_VERTEX_ARRAY_BIT)
+    glEnableClientState (GL_VERTEX_ARRAY)
+    glVertexPointer (3, GL_FLOAT, 0, verts)
+    glDrawArrays (GL_QUADS, 0, 4 * sides)
+    if closed:
+        glDrawArrays (GL_TRIANGLE_FAN, 4 * sides, sides + 2)
+        glDrawArrays (GL_TRIANGLE_FAN, 5 * sides + 2, sides + 2)
+    glPopClientAttrib ()
 
 #-------------------------------------------------------------------------------
 # A version routine that returns the timestamp maintained by Emacs.
@@ -1174,11 +1772,6 @@ def version ():
     "Return the version of this library."
     return timestamp[13:-1]
 
-#-------------------------------------------------------------------------------
-# Load the default keymap.
-#-------------------------------------------------------------------------------
-load_keys ("nil.kbd")
-
 timestamp = "Time-stamp: <2018-07-01 17:56:06 Adrian F Clark (alien@essex.ac.uk)>"
 # Local Variables:
 # time-stamp-line-limit: -10